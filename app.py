@@ -1,17 +1,34 @@
+"""Kunstlotteri app: turns a Vipps report into participant lists for Wheel of Names.
+
+Hot path is xlsx parse + groupby; engine=calamine and category dtypes are the
+two biggest wins. Plotly is only imported when a pie chart is shown.
+"""
+import io
 import re
+import html
 import math
+import string
+import uuid
+import numpy as np
 import pandas as pd
 import streamlit as st
-import plotly.express as px
 import streamlit.components.v1 as components
-import base64
 from pathlib import Path
 from urllib.parse import quote
 
 # -----------------------------
 # Helpers
 # -----------------------------
-BILDE_RE = re.compile(r"lodd\s*bilde\s*([A-Z])", re.IGNORECASE)
+# Both filters and captures lottery rows: Salgssted must contain literal "Lodd bilde" (one space)
+BILDE_RE = re.compile(r"lodd bilde\s*([A-Z])", re.IGNORECASE)
+
+# Kolonner fra rapporten som brukes videre; resten droppes rett etter innlesing
+REPORT_COLS = ("Salgsdato", "Salgssted", "Transaksjonstype", "Brutto", "Fornavn", "Etternavn", "Melding")
+TEXT_COLS = ("Salgssted", "Transaksjonstype", "Fornavn", "Etternavn", "Melding")
+# Arrow-backed strings: str-operasjoner kjører på Arrow-kjerner i stedet for Python-objekter
+STRING_DTYPE = "string[pyarrow]"
+# Cached stages are keyed on the uploaded bytes; bound them so old reports are evicted
+CACHE_MAX_ENTRIES = 16
 
 def find_header_row(raw: pd.DataFrame) -> int | None:
     """Find the row index where the table header starts (contains 'Salgssted')."""
@@ -21,114 +38,231 @@ def find_header_row(raw: pd.DataFrame) -> int | None:
             return i
     return None
 
-def read_vipps_report(uploaded_file) -> pd.DataFrame:
-    """Read Vipps report and return a normalized dataframe."""
-    raw = pd.read_excel(uploaded_file, header=None)
+def header_labels(values) -> list[str]:
+    """Unique, stripped column labels from a header row, named the way pandas' read_excel would.
+
+    Blank cells become 'Unnamed: i' and repeats get '.1', '.2', ... suffixes
+    (skipping suffixed names already present in the header).
+    """
+    labels = []
+    unnamed = []
+    for i, v in enumerate(values):
+        if pd.isna(v) or not str(v).strip():
+            labels.append(f"Unnamed: {i}")
+            unnamed.append(i)
+        else:
+            labels.append(str(v).strip())
+
+    counts: dict[str, int] = {}
+    for i in [i for i in range(len(labels)) if i not in unnamed] + unnamed:
+        label = original = labels[i]
+        count = counts.get(original, 0)
+        while count > 0:
+            counts[original] = count + 1
+            label = f"{original}.{count}"
+            count = count + 1 if label in labels else counts.get(label, 0)
+        labels[i] = label
+        counts[label] = count + 1
+    return labels
+
+def read_vipps_report(data: bytes) -> pd.DataFrame:
+    """Read Vipps report (raw .xlsx bytes) and return a normalized dataframe."""
+    # Parse the sheet once; the header row is promoted from the same frame
+    raw = pd.read_excel(io.BytesIO(data), header=None, engine="calamine")
     header_row = find_header_row(raw)
     if header_row is None:
         raise ValueError("Fant ikke header-raden (kolonnen 'Salgssted'). Er dette riktig Vipps-rapport?")
 
-    df = pd.read_excel(uploaded_file, header=header_row)
+    df = raw.iloc[header_row + 1:].reset_index(drop=True).infer_objects()
+    df.columns = header_labels(raw.iloc[header_row])
 
     # In many Vipps exports, first data row repeats header labels
     # Example: first row has "Salgsdato", "Salgssted", etc. as values.
-    if len(df) > 0 and str(df.iloc[0].get("Salgssted", "")).strip().lower() == "salgssted":
-        df.columns = df.iloc[0].tolist()
-        df = df.iloc[1:].copy()
+    if len(df) > 0 and "Salgssted" in df.columns and str(df["Salgssted"].iat[0]).strip().lower() == "salgssted":
+        df.columns = header_labels(df.iloc[0])
+        df = df.iloc[1:]
 
-    # Trim whitespace in column names
-    df.columns = [str(c).strip() for c in df.columns]
-    return df
+    return df.astype({c: STRING_DTYPE for c in TEXT_COLS if c in df.columns})
 
-def build_full_name(row) -> str:
-    fn = str(row.get("Fornavn", "")).strip()
-    en = str(row.get("Etternavn", "")).strip()
+def _clean_text_col(df: pd.DataFrame, col: str) -> pd.Series:
+    """Stripped string column with missing values / literal 'nan' as ''."""
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=STRING_DTYPE)
+    s = df[col].astype(STRING_DTYPE).str.strip().fillna("")
+    return s.mask(s.str.lower().eq("nan"), "")
 
-    if fn and fn.lower() != "nan":
-        return (fn + " " + en).strip() if en and en.lower() != "nan" else fn
+def build_full_names(df: pd.DataFrame) -> pd.Series:
+    fn = _clean_text_col(df, "Fornavn")
+    en = _clean_text_col(df, "Etternavn")
+    full = (fn + " " + en).str.strip()
 
     # Fallback: sometimes "Melding" contains name
-    msg = str(row.get("Melding", "")).strip()
-    if msg and msg.lower() != "nan":
-        return msg
+    msg = _clean_text_col(df, "Melding")
+    return full.where(fn.ne(""), msg.where(msg.ne(""), "Ukjent"))
+
+def extract_bilde(salgssted: pd.Series) -> pd.Series:
+    """Picture letter from 'Lodd bilde X' per row (NaN where there is no match)."""
+    return salgssted.str.extract(BILDE_RE, expand=False).str.upper()
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_lodd_table(data: bytes, name_mode: str) -> pd.DataFrame:
+    """Lottery sales rows from the report, with Bilde, Navn and numeric Brutto."""
+    df = read_vipps_report(data)
+
+    required_cols = {"Salgssted", "Transaksjonstype", "Brutto"}
+    missing = [c for c in required_cols if c not in df.columns]
+    if missing:
+        raise ValueError(f"Mangler forventede kolonner i rapporten: {missing}")
+
+    # Normalize & filter relevant rows
+    df = df[[c for c in REPORT_COLS if c in df.columns]].astype({"Transaksjonstype": "category"})
+
+    # Filter and capture picture letter in one regex pass over the sales rows
+    # Few distinct types: normalize the categories once, then match on int codes
+    ttype = df["Transaksjonstype"].cat
+    sale_codes = np.flatnonzero(ttype.categories.astype(str).str.strip().str.lower() == "salg")
+    sales = df[ttype.codes.isin(sale_codes)]
+    bilde_col = extract_bilde(sales["Salgssted"])
+    has_bilde = bilde_col.notna()
+    df_lodd = sales[has_bilde].assign(Bilde=bilde_col[has_bilde])
+
+    # Brutto numeric
+    df_lodd["Brutto"] = pd.to_numeric(df_lodd["Brutto"], errors="coerce").fillna(0)
+
+    # Bygg Navn-kolonne (må finnes før groupby)
+    df_lodd["Navn"] = build_full_names(df_lodd)
+
+    if name_mode == "Kun fornavn":
+        df_lodd["Navn"] = df_lodd["Navn"].apply(
+            lambda s: str(s).strip().split(" ")[0] if str(s).strip() else "Ukjent"
+        )
+
+    # Kategoriske nøkler gjør groupby til int-kode-sammenligninger
+    df_lodd["Bilde"] = df_lodd["Bilde"].astype("category")
+    df_lodd["Navn"] = df_lodd["Navn"].astype("category")
+    return df_lodd
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def compute_agg(data: bytes, loddpris: int, name_mode: str, round_down: bool) -> pd.DataFrame:
+    """Total Brutto and ticket count per (Bilde, Navn)."""
+    df_lodd = build_lodd_table(data, name_mode)
+
+    # Summer brutto per bilde/person FØRST (viktig for kjøp i flere omganger)
+    agg = (
+        df_lodd.groupby(["Bilde", "Navn"], as_index=False, observed=True, sort=False)
+        .agg(Brutto=("Brutto", "sum"))
+    )
 
-    return "Ukjent"
+    # Regn ut lodd basert på total brutto, i hele øre for å unngå flyttallsrester
+    brutto_ore = np.rint(agg["Brutto"].to_numpy() * 100).astype("int64")
+    price_ore = int(loddpris) * 100
+    lodd, rest_ore = np.divmod(brutto_ore, price_ore)
+    if not round_down:
+        # Runder halvveis til partall, som np.rint
+        lodd += (2 * rest_ore > price_ore) | ((2 * rest_ore == price_ore) & (lodd % 2 == 1))
 
-def extract_bilde(salgssted: str) -> str | None:
-    if not salgssted or str(salgssted).lower() == "nan":
-        return None
-    m = BILDE_RE.search(str(salgssted))
-    return m.group(1).upper() if m else None
+    agg["Lodd_raw"] = brutto_ore / price_ore
+    agg["Lodd"] = lodd
+    agg["Rest_ore"] = rest_ore
+
+    # Clamp negative totals per person to 0 (refunds may net out)
+    agg["Lodd_clamped"] = agg["Lodd"].clip(lower=0)
+    return agg
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def build_draws(data: bytes, loddpris: int, name_mode: str, round_down: bool) -> dict[str, dict]:
+    """Per-picture wheel list, top 10 and totals, ready for rendering."""
+    agg = compute_agg(data, loddpris, name_mode, round_down)
+
+    # Del opp agg per bilde én gang i stedet for et filter per fane
+    draws = {}
+    for bilde, g in agg.groupby("Bilde", observed=True, sort=False):
+        sub = g.sort_values(["Lodd", "Navn"], ascending=[False, True])
+
+        # Winner list text
+        counts = sub["Lodd_clamped"].to_numpy()
+        names = sub["Navn"].astype(str).to_numpy()
+        has_lodd = counts > 0
+
+        draws[bilde] = {
+            "wheel_text": "\n".join(np.repeat(names[has_lodd], counts[has_lodd]).tolist()),
+            "top10": sub[has_lodd].iloc[:10],
+            "total_lodd": int(counts.sum()),
+            "buyers": int(has_lodd.sum()),
+            "total_brutto": float(sub["Brutto"].sum()),
+        }
+    return draws
+
+# Static CSS/JS for copy_button; only the id, text and label vary per call
+_COPY_TEMPLATE = string.Template("""
+<style>
+  .gc-copy-btn {
+    appearance: none;
+    background: white;
+    color: rgb(17, 24, 39);
+    border: 1px solid rgba(49, 51, 63, 0.2);
+    border-radius: 0.5rem;
+    padding: 0.6rem 1rem;
+    font-size: 1rem;
+    font-weight: 600;
+    font-family: inherit;
+    line-height: 1.2;
+    cursor: pointer;
+    width: 100%;
+    min-height: 2.75rem;
+    display: inline-flex;
+    align-items: center;
+    justify-content: center;
+    gap: 0.5rem;
+    user-select: none;
+    transition: background 120ms ease, border-color 120ms ease, transform 80ms ease;
+  }
+  .gc-copy-btn:hover {
+    background: rgba(0, 0, 0, 0.02);
+    border-color: rgba(49, 51, 63, 0.35);
+  }
+  .gc-copy-btn:active {
+    transform: translateY(1px);
+  }
+  .gc-copy-wrap {
+    width: 100%;
+  }
+</style>
+
+<div class="gc-copy-wrap">
+  <button id="$btn_id" class="gc-copy-btn">$label</button>
+</div>
+
+<script>
+  const btn = document.getElementById("$btn_id");
+  const original = btn.textContent;
+
+  btn.addEventListener("click", async () => {
+    try {
+      await navigator.clipboard.writeText(`$safe`);
+      btn.textContent = "✅ Kopiert!";
+      setTimeout(() => {
+        btn.textContent = original;
+      }, 1400);
+    } catch (e) {
+      btn.textContent = "⚠️ Feil – kopier manuelt";
+      setTimeout(() => {
+        btn.textContent = original;
+      }, 2000);
+    }
+  });
+</script>
+""")
+
+# Escape for embedding in a JS template literal
+_JS_TEMPLATE_ESCAPE = str.maketrans({"\\": "\\\\", "`": "\\`", "$": "\\$"})
 
 def copy_button(text: str, label: str = "📋 Kopiér liste"):
     btn_id = f"copy_{uuid.uuid4().hex}"
-
-    safe = (
-        text.replace("\\", "\\\\")
-            .replace("`", "\\`")
-            .replace("$", "\\$")
-    )
+    safe = text.translate(_JS_TEMPLATE_ESCAPE)
 
     components.html(
-        f"""
-        <style>
-          .gc-copy-btn {{
-            appearance: none;
-            background: white;
-            color: rgb(17, 24, 39);
-            border: 1px solid rgba(49, 51, 63, 0.2);
-            border-radius: 0.5rem;
-            padding: 0.6rem 1rem;
-            font-size: 1rem;
-            font-weight: 600;
-            font-family: inherit;
-            line-height: 1.2;
-            cursor: pointer;
-            width: 100%;
-            min-height: 2.75rem;
-            display: inline-flex;
-            align-items: center;
-            justify-content: center;
-            gap: 0.5rem;
-            user-select: none;
-            transition: background 120ms ease, border-color 120ms ease, transform 80ms ease;
-          }}
-          .gc-copy-btn:hover {{
-            background: rgba(0, 0, 0, 0.02);
-            border-color: rgba(49, 51, 63, 0.35);
-          }}
-          .gc-copy-btn:active {{
-            transform: translateY(1px);
-          }}
-          .gc-copy-wrap {{
-            width: 100%;
-          }}
-        </style>
-
-        <div class="gc-copy-wrap">
-          <button id="{btn_id}" class="gc-copy-btn">{html.escape(label)}</button>
-        </div>
-
-        <script>
-          const btn = document.getElementById("{btn_id}");
-          const original = btn.textContent;
-
-          btn.addEventListener("click", async () => {{
-            try {{
-              await navigator.clipboard.writeText(`{safe}`);
-              btn.textContent = "✅ Kopiert!";
-              setTimeout(() => {{
-                btn.textContent = original;
-              }}, 1400);
-            }} catch (e) {{
-              btn.textContent = "⚠️ Feil – kopier manuelt";
-              setTimeout(() => {{
-                btn.textContent = original;
-              }}, 2000);
-            }}
-          }});
-        </script>
-        """,
+        _COPY_TEMPLATE.substitute(btn_id=btn_id, safe=safe, label=html.escape(label)),
         height=60,
     )
 
@@ -162,61 +296,21 @@ if not uploaded:
     st.info("Last opp Vipps-rapporten for å komme i gang.")
     st.stop()
 
+data = uploaded.getvalue()
+
 try:
-    df = read_vipps_report(uploaded)
+    df_lodd = build_lodd_table(data, name_mode)
 except Exception as e:
     st.error(str(e))
     st.stop()
 
-required_cols = {"Salgssted", "Transaksjonstype", "Brutto"}
-missing = [c for c in required_cols if c not in df.columns]
-if missing:
-    st.error(f"Mangler forventede kolonner i rapporten: {missing}")
-    st.stop()
-
-# Normalize & filter relevant rows
-df["Salgssted"] = df["Salgssted"].astype(str)
-df["Transaksjonstype"] = df["Transaksjonstype"].astype(str)
-
-df_lodd = df[
-    df["Transaksjonstype"].str.strip().str.lower().eq("salg")
-    & df["Salgssted"].str.contains("Lodd bilde", case=False, na=False)
-].copy()
-
 if df_lodd.empty:
     st.warning("Fant ingen lodd-rader (Transaksjonstype='Salg' og Salgssted inneholder 'Lodd bilde').")
     st.stop()
 
-df_lodd["Bilde"] = df_lodd["Salgssted"].apply(extract_bilde)
-df_lodd = df_lodd[df_lodd["Bilde"].notna()].copy()
-
-# Brutto numeric
-df_lodd["Brutto"] = pd.to_numeric(df_lodd["Brutto"], errors="coerce").fillna(0)
-
-# Bygg Navn-kolonne (må finnes før groupby)
-df_lodd["Navn"] = df_lodd.apply(build_full_name, axis=1)
-
-if name_mode == "Kun fornavn":
-    df_lodd["Navn"] = df_lodd["Navn"].apply(
-        lambda s: str(s).strip().split(" ")[0] if str(s).strip() else "Ukjent"
-    )
-
-# Summer brutto per bilde/person FØRST (viktig for kjøp i flere omganger)
-agg = (
-    df_lodd.groupby(["Bilde", "Navn"], as_index=False)
-    .agg(Brutto=("Brutto", "sum"))
-)
-
-# Regn ut lodd basert på total brutto
-agg["Lodd_raw"] = agg["Brutto"] / float(loddpris)
-if round_down:
-    agg["Lodd"] = agg["Lodd_raw"].apply(lambda v: int(math.floor(v)))
-else:
-    agg["Lodd"] = agg["Lodd_raw"].round().astype(int)
-
-agg["Lodd"] = agg["Lodd"].astype(int)
+agg = compute_agg(data, loddpris, name_mode, round_down)
 
-non_multiple = agg[(agg["Brutto"] % float(loddpris)) != 0]
+non_multiple = agg[agg["Rest_ore"] != 0]
 if len(non_multiple) > 0:
     st.warning(
         f"{len(non_multiple)} kjøpere har totalbeløp som ikke går opp i loddpris ({loddpris} kr). "
@@ -241,28 +335,18 @@ tabs = st.tabs([f"Bilde {b}" for b in bilder])
 
 WHEEL_URL = "https://wheelofnames.com/"
 
+draws = build_draws(data, loddpris, name_mode, round_down)
+
 for tab, bilde in zip(tabs, bilder):
     with tab:
         left, right = st.columns([1.1, 0.9], gap="large")
 
-        sub = agg[agg["Bilde"] == bilde].copy().sort_values(["Lodd", "Navn"], ascending=[False, True])
-
-        # Clamp negative totals per person to 0 (refunds may net out)
-        sub["Lodd_clamped"] = sub["Lodd"].apply(lambda x: max(int(x), 0))
-
-        total_lodd = int(sub["Lodd_clamped"].sum())
-        buyers = int((sub["Lodd_clamped"] > 0).sum())
-        total_brutto = float(sub["Brutto"].sum())
-
-        # Winner list text
-        wheel_names = []
-        for _, r in sub.iterrows():
-            count = int(r["Lodd_clamped"])
-            if count <= 0:
-                continue
-            wheel_names.extend([str(r["Navn"])] * count)
-
-        wheel_text = "\n".join(wheel_names)
+        draw = draws[bilde]
+        wheel_text = draw["wheel_text"]
+        top10 = draw["top10"]
+        total_lodd = draw["total_lodd"]
+        buyers = draw["buyers"]
+        total_brutto = draw["total_brutto"]
 
         with left:
             st.subheader("Trekning")
@@ -280,7 +364,6 @@ for tab, bilde in zip(tabs, bilder):
 
             # Flyttet hit fra høyresiden:
             st.caption("Topp 10 kjøpere (etter antall lodd)")
-            top10 = sub[sub["Lodd_clamped"] > 0].head(10).copy()
 
             if top10.empty:
                 st.info("Ingen kjøpere med lodd > 0.")
@@ -309,18 +392,23 @@ for tab, bilde in zip(tabs, bilder):
                 )
 
                 if chart_type == "Stolpediagram":
-                    fig = px.bar(top10, x="Navn", y="Lodd_clamped")
-                    fig.update_layout(xaxis_title="", yaxis_title="Lodd")
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.bar_chart(
+                        top10, x="Navn", y="Lodd_clamped",
+                        x_label="", y_label="Lodd", sort=False,
+                    )
                 else:
-                    fig = px.pie(top10, names="Navn", values="Lodd_clamped")
+                    # Streamlit har ikke kakediagram; Plotly importeres kun her
+                    import plotly.graph_objects as go
+
+                    fig = go.Figure(go.Pie(labels=top10["Navn"].astype(str), values=top10["Lodd_clamped"]))
                     st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("Ingen data å vise i diagrammet.")
 
                 with st.expander(f"Vis tolket datagrunnlag for bilde {bilde}"):
-                    df_dbg = df_lodd[df_lodd["Bilde"] == bilde].copy()
-                    df_dbg["Lodd_raw"] = df_dbg["Brutto"] / float(loddpris)
+                    df_dbg = df_lodd[df_lodd["Bilde"] == bilde].assign(
+                        Lodd_raw=lambda d: d["Brutto"] / float(loddpris)
+                    )
 
                     # Velg kolonner som finnes
                     cols = [c for c in ["Salgsdato", "Salgssted", "Navn", "Brutto", "Lodd_raw", "Melding"] if c in df_dbg.columns]
@@ -338,7 +426,10 @@ for tab, bilde in zip(tabs, bilder):
 
 st.divider()
 
+@st.cache_data(show_spinner=False)
 def svg_to_data_uri(svg_path: str) -> str | None:
+    import base64
+
     try:
         svg_bytes = Path(svg_path).read_bytes()
     except FileNotFoundError: